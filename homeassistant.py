@@ -1,41 +1,210 @@
+import collections
 import json
 import logging
 import paho.mqtt.client as mqtt
+import profiling
 import pwrcell
+import spool
 import sunspec2.mdef as mdef
 import sunspec2.modbus.client as ss2_client
+import threading
 import time
 
+# Time in seconds after which Home Assistant marks a sensor unavailable if no new state was published
+EXPIRES_AFTER = 14400
+
 
 class TimeMovingAvg():
   def __init__(self, max_age: int = 60):
     self.__max_age = max_age
-    self.__points = []
+    # Tuple of (ts, value) that is replaced rather than modified, window() can be called from any thread
+    self.__points = ()
 
-  def accumulate(self, value: float):
-    now = time.time()
-    self.__points.append({'ts': now, 'v': value})
-    average = None
-    slice_idx = 0
-    for idx, p in enumerate(self.__points):
-      if (now - p['ts']) > self.__max_age:
-        slice_idx = idx + 1
-      elif average is None:
-        average = p['v']
-      else:
-        average += p['v']
-    self.__points = self.__points[slice_idx:]
-    return average / len(self.__points)
+  def accumulate(self, value: float, ts: float = None):
+    now = time.time() if ts is None else ts
+    points = tuple(p for p in self.__points if (now - p[0]) <= self.__max_age) + ((now, value),)
+    self.__points = points
+    return sum(v for _, v in points) / len(points)
+
+  def window(self):
+    """
+    The samples currently in the window as [timestamp, value] pairs
+    """
+    return [[ts, v] for ts, v in self.__points]
+
+  def restore(self, window: list[list[float]]):
+    """
+    Seed the window with samples from window(), samples that are already too old are dropped on the next accumulate
+    """
+    self.__points = tuple((ts, v) for ts, v in window)
+
+
+class WindowStats():
+  """
+  Min/max of the samples added since the last reset, their time-weighted mean and, for power values, the energy in
+  Wh (trapezoidal, including the interval from the previous window's last sample). Intervals longer than max_gap
+  (e.g. an offline device) are left out rather than interpolated across. Computed incrementally, samples are not kept.
+  """
+
+  def __init__(self, start: float = None, integrate: bool = False, max_gap: float = 180):
+    self.__integrate = integrate
+    self.__max_gap = max_gap
+    self.__last = None
+    self.reset(time.time() if start is None else start)
+
+  def reset(self, start: float):
+    self.start = start
+    self.__count = 0
+    self.__min = None
+    self.__max = None
+    # Integral of the value over time (value * seconds) and the time it covers
+    self.__area = 0
+    self.__duration = 0
+
+  def add(self, value: float, ts: float):
+    self.__count += 1
+    self.__min = value if self.__min is None else min(self.__min, value)
+    self.__max = value if self.__max is None else max(self.__max, value)
+    if self.__last is not None:
+      last_ts, last_value = self.__last
+      if 0 < ts - last_ts <= self.__max_gap:
+        self.__area += (last_value + value) / 2 * (ts - last_ts)
+        self.__duration += ts - last_ts
+    self.__last = (ts, value)
+
+  def result(self):
+    if self.__duration > 0:
+      mean = self.__area / self.__duration
+    else:
+      mean = self.__last[1] if self.__count else None
+    stats = {
+        'min': self.__min,
+        'max': self.__max,
+        'mean': mean,
+        'samples': self.__count,
+    }
+    if self.__integrate:
+      stats['energy_wh'] = self.__area / 3600
+    return stats
+
+
+class LatestValueQueue():
+  """
+  Bounded queue that holds only the latest item per key, putting an item for a key that is already queued replaces
+  the queued item in place so intermediate values are dropped instead of backing up the producer
+  """
+
+  def __init__(self, maxsize: int = 1000):
+    self.__maxsize = maxsize
+    self.__items = collections.OrderedDict()
+    self.__cond = threading.Condition()
+    self.__closed = False
+    self.dropped = 0
+
+  def put(self, key, item):
+    with self.__cond:
+      if key in self.__items:
+        self.dropped += 1
+      elif len(self.__items) >= self.__maxsize:
+        self.__items.popitem(last=False)
+        self.dropped += 1
+      self.__items[key] = item
+      self.__cond.notify()
+
+  def get(self, timeout: float = None):
+    """
+    Oldest (key, item) pair, None if the timeout expires or the queue is closed and empty
+    """
+    with self.__cond:
+      self.__cond.wait_for(lambda: self.__items or self.__closed, timeout)
+      if not self.__items:
+        return None
+      return self.__items.popitem(last=False)
+
+  @property
+  def closed(self):
+    return self.__closed
+
+  def close(self):
+    with self.__cond:
+      self.__closed = True
+      self.__cond.notify_all()
 
 
 class PwrCellHA():
-  def __init__(self, pwrcell: pwrcell.GeneracPwrCell, mqttc: mqtt.Client, testing: bool = False):
+  def __init__(self, pwrcell: pwrcell.GeneracPwrCell, mqttc: mqtt.Client, testing: bool = False,
+               profiler: profiling.Profiler = None, state_spool: spool.Spool = None, drain_rate: float = 20,
+               aggregation_window: float = 0, aggregation_max_gap: float = 180):
     self.__ha_topic = "homeassistant"
     if testing:
       self.__ha_topic = "TEST/{}".format(self.__ha_topic)
 
     self.__pwrcell = pwrcell
     self.__mqttc = mqttc
+    self.__command_topics = []
+    self.__profiler = profiler or profiling.Profiler()
+    self.__initialized = False
+    self.__discovery = {}
+    # Replaced rather than modified by the publisher thread so snapshot() can copy it from the main thread
+    self.__states = {}
+    self.__tmas = {}
+    self.__restored = None
+    # Reads are handed from the ModBusPool threads to the publisher thread so polling never waits on MQTT
+    self.__state_queue = LatestValueQueue()
+    self.__state_updaters = {}
+    self.__publisher = threading.Thread(target=self.__publish_states, name='Publisher', daemon=True)
+    # States are spooled to disk while the broker is unreachable and drained at drain_rate per second afterwards
+    self.__spool = state_spool
+    self.__drain_rate = drain_rate
+    self.__last_drain = 0
+    self.__drain_credit = 0
+    # Measurements are published as windowed statistics every aggregation_window seconds instead of per read
+    self.__aggregation_window = aggregation_window
+    self.__aggregation_max_gap = aggregation_max_gap
+
+  def restore(self, snapshot: dict, max_age: float = EXPIRES_AFTER):
+    """
+    Restore the last known state from a snapshot(), discovery and states are published by publish_snapshot() and
+    moving averages are seeded as sensors are defined in init(). States and moving averages of a snapshot saved more
+    than max_age seconds ago are dropped, they would be shown as current values.
+    """
+    age = time.time() - snapshot.get('saved_at', 0)
+    if age > max_age:
+      logging.info("Snapshot is %.0fs old, only restoring discovery", age)
+      snapshot = {'discovery': snapshot.get('discovery', {}), 'saved_at': snapshot.get('saved_at', 0)}
+    self.__restored = snapshot
+
+  def publish_snapshot(self):
+    """
+    Publish restored discovery and states so Home Assistant has values before the devices have been scanned, does
+    nothing once init() has completed and skips states that have already been published live
+    """
+    if self.__restored is None or self.__initialized:
+      return
+    restored_discovery = self.__restored.get('discovery', {})
+    restored_states = self.__restored.get('states', {})
+    for config_topic, entity_config in restored_discovery.items():
+      self.__mqttc.publish(config_topic, entity_config, retain=True)
+    published = 0
+    for state_topic, p_value in restored_states.items():
+      if state_topic not in self.__states:
+        self.__mqttc.publish(state_topic, p_value)
+        published += 1
+    logging.info("Published %s restored states", published)
+
+  def snapshot(self):
+    """
+    Compact snapshot of discovery, last published states and moving average windows for restore()
+    """
+    if not self.__initialized and self.__restored is not None:
+      # Nothing live yet, keep the previous run's state rather than overwriting it with an empty snapshot
+      return self.__restored
+    return {
+        'discovery': dict(self.__discovery),
+        'states': self.__states,
+        'averages': {state_topic: tma.window() for state_topic, tma in list(self.__tmas.items())},
+        'saved_at': time.time(),
+    }
 
   def init(self):
     self.__define_select(
@@ -158,13 +327,17 @@ class PwrCellHA():
           device_id=device_id,
           sensor_id='pvlink_state')
 
-  def __point_to_ha(self, point: ss2_client.SunSpecModbusClientPoint):
+    self.__initialized = True
+    self.__restored = None
+    self.__publisher.start()
+
+  def __point_to_ha(self, point: ss2_client.SunSpecModbusClientPoint, cvalue):
     # For enum types find the name for the value
     if pwrcell.is_enum(point):
       symbols = point.pdef[mdef.SYMBOLS]
-      return next(symbol for symbol in symbols if symbol[mdef.VALUE] == point.cvalue)[mdef.NAME]
+      return next(symbol for symbol in symbols if symbol[mdef.VALUE] == cvalue)[mdef.NAME]
 
-    return point.cvalue
+    return cvalue
 
   def __ha_to_point(self, point: ss2_client.SunSpecModbusClientPoint, payload):
     # For enum types look up the value for the name, throws if no match
@@ -174,25 +347,89 @@ class PwrCellHA():
 
     return payload
 
-  def __update_state(self, point: ss2_client.SunSpecModbusClientPoint, state_topic: str, round_digits: int = -1,
-                     tma: TimeMovingAvg = None, negate: bool = False):
-    p_value = self.__point_to_ha(point)
-    p_value = tma.accumulate(p_value) if tma is not None else p_value
-    p_value = round(p_value, round_digits) if round_digits >= 0 else p_value
-    p_value = -1 * p_value if negate else p_value
+  def __queue_state(self, point: ss2_client.SunSpecModbusClientPoint, state_topic: str):
+    # The point itself may already be decoding the next read, take the value from the snapshot of this one
+    point_value = self.__pwrcell.point_value(point)
+    self.__state_queue.put(state_topic, (self.__point_to_ha(point, point_value.cvalue), point_value.ts))
+
+  def __publish_states(self):
+    while True:
+      queued = self.__state_queue.get(timeout=1 if self.__spool is not None else None)
+      if queued is not None:
+        state_topic, (p_value, ts) = queued
+        try:
+          self.__state_updaters[state_topic](p_value, ts)
+        except Exception:
+          logging.exception("Failed to publish %s", state_topic)
+      elif self.__spool is None or self.__state_queue.closed:
+        break
+      self.__drain_spool()
+
+  def __publish_state(self, state_topic: str, p_value, ts: float, history: bool = False):
+    if self.__spool is not None and (self.__spool.pending() or not self.__mqttc.is_connected()):
+      # Anything published before the spool has drained would be overwritten by older spooled states
+      self.__spool.put(state_topic, p_value, ts, history=history)
+      return
+    info = self.__mqttc.publish(state_topic, p_value)
+    if info.rc != mqtt.MQTT_ERR_SUCCESS and self.__spool is not None:
+      self.__spool.put(state_topic, p_value, ts, history=history)
+
+  def __drain_spool(self):
+    if self.__spool is None or not self.__spool.pending() or not self.__mqttc.is_connected():
+      return
+    # Credit accrues at drain_rate per second, up to one second's worth (or one state for rates below 1/s), so
+    # fractional rates carry over between calls
+    now = time.time()
+    self.__drain_credit = min(max(1, self.__drain_rate),
+                              self.__drain_credit + (now - self.__last_drain) * self.__drain_rate)
+    self.__last_drain = now
+    limit = int(self.__drain_credit)
+    if limit < 1:
+      return
+
+    published = []
+    for key, state_topic, payload in self.__spool.peek(limit):
+      if self.__mqttc.publish(state_topic, payload).rc != mqtt.MQTT_ERR_SUCCESS:
+        break
+      published.append(key)
+    self.__spool.remove(published)
+    self.__drain_credit -= len(published)
+    logging.info("Published %s spooled states, %s remaining", len(published), self.__spool.pending())
+
+  def __update_state(self, p_value, ts: float, state_topic: str, round_digits: int = -1,
+                     tma: TimeMovingAvg = None, negate: bool = False, history: bool = False,
+                     stats: WindowStats = None, attributes_topic: str = None):
+    if stats is not None:
+      stats.add(-1 * p_value if negate else p_value, ts)
+      if ts - stats.start < self.__aggregation_window:
+        return
+      window = stats.result()
+      stats.reset(ts)
+      if round_digits >= 0:
+        window = {k: round(v, round_digits) if isinstance(v, float) else v for k, v in window.items()}
+      p_value = window['mean']
+      logging.info("Publish {}: {}".format(attributes_topic, window))
+      self.__publish_state(attributes_topic, json.dumps(window), ts)
+    else:
+      if tma is not None:
+        with self.__profiler.span('average', topic=state_topic):
+          p_value = tma.accumulate(p_value, ts)
+      p_value = round(p_value, round_digits) if round_digits >= 0 else p_value
+      p_value = -1 * p_value if negate else p_value
     logging.info("Publish {}: {}".format(state_topic, p_value))
-    self.__mqttc.publish(state_topic, p_value)
+    with self.__profiler.span('publish', topic=state_topic):
+      self.__publish_state(state_topic, p_value, ts, history=history)
+    self.__states = self.__states | {state_topic: p_value}
 
   def __handle_command(self, point: ss2_client.SunSpecModbusClientPoint, command_topic: str, client, userdata, msg):
     try:
       payload = msg.payload.decode('utf-8')
       new_value = self.__ha_to_point(point, payload)
+      current = self.__pwrcell.point_value(point)
       logging.info("Changing {} from {} to {}".format(
-          pwrcell.point_id(point), point.cvalue, new_value))
-      point.cvalue = new_value
-      point.write()
-      # Immediately re-read the value after writing, will update the state topic
-      self.__pwrcell.read_point(point)
+          pwrcell.point_id(point), current.cvalue if current is not None else None, new_value))
+      # Immediately re-reads the value after writing, will update the state topic
+      self.__pwrcell.write_point(point, new_value)
     except Exception:
       logging.exception("Failed to handle command %s on %s for %s",
                         msg.payload, command_topic, pwrcell.point_id(point))
@@ -244,7 +481,7 @@ class PwrCellHA():
         "name": "{}: {}".format(device_name, point.pdef[mdef.LABEL]),
         "unique_id": "{}_{}".format(device_id, sensor_id),
         "state_topic": state_topic,
-        "expires_after": 14400,
+        "expires_after": EXPIRES_AFTER,
     }
 
     if point.pdef.get(mdef.ACCESS) == mdef.ACCESS_RW:
@@ -252,20 +489,37 @@ class PwrCellHA():
           self.__ha_topic, entity_type, device_id, sensor_id)
       entity_config['command_topic'] = command_topic
       # Subscribe to command topic and register callback
+      self.__command_topics.append(command_topic)
       self.__mqttc.subscribe(command_topic)
       self.__mqttc.message_callback_add(
           command_topic, lambda client, userdata, msg: self.__handle_command(point, command_topic, client, userdata, msg))
 
     # Register watch/callback with pwrcell for point
-    tma = TimeMovingAvg() if moving_average else None
-    self.__pwrcell.watch_point(
-        point, (lambda p: self.__update_state(p, state_topic, round_digits=round_digits, tma=tma, negate=negate)))
+    tma = None
+    if moving_average:
+      tma = TimeMovingAvg()
+      if self.__restored is not None:
+        tma.restore(self.__restored.get('averages', {}).get(state_topic, []))
+      self.__tmas[state_topic] = tma
+    # Spool every state of accumulating counters so Home Assistant sees all the energy from an outage
+    history = entity_config.get('state_class') == 'total_increasing'
+    stats = None
+    attributes_topic = None
+    if self.__aggregation_window > 0 and entity_config.get('state_class') == 'measurement':
+      stats = WindowStats(integrate=point.pdef.get(mdef.UNITS) == 'W', max_gap=self.__aggregation_max_gap)
+      attributes_topic = "{}/{}/{}/{}/attributes".format(
+          self.__ha_topic, entity_type, device_id, sensor_id)
+      entity_config['json_attributes_topic'] = attributes_topic
+    self.__state_updaters[state_topic] = (lambda p_value, ts: self.__update_state(
+        p_value, ts, state_topic, round_digits=round_digits, tma=tma, negate=negate, history=history,
+        stats=stats, attributes_topic=attributes_topic))
+    self.__pwrcell.watch_point(point, (lambda p: self.__queue_state(p, state_topic)))
 
     # Publish Discovery
     logging.info("Binding %s to %s %s", config_topic,
                  pwrcell.point_id(point), pwrcell.point_sf_info(point))
-    self.__mqttc.publish(config_topic, json.dumps(
-        entity_config, indent=2, sort_keys=True), retain=True)
+    self.__discovery[config_topic] = json.dumps(entity_config, indent=2, sort_keys=True)
+    self.__mqttc.publish(config_topic, self.__discovery[config_topic], retain=True)
 
   def __create_device(self, device: ss2_client.SunSpecModbusClientDevice, device_name: str):
     return {
@@ -321,6 +575,21 @@ class PwrCellHA():
     symbols = sorted(symbols, key=lambda s: s[mdef.VALUE])
     return list(map(lambda symbol: symbol[mdef.NAME], symbols))
 
+  def subscribe(self):
+    """
+    (Re)subscribe to all command topics, must be called whenever the MQTT client (re)connects
+    """
+    for command_topic in self.__command_topics:
+      self.__mqttc.subscribe(command_topic)
+
+  def close(self):
+    """
+    Publish any queued states and stop the publisher thread
+    """
+    self.__state_queue.close()
+    if self.__publisher.is_alive():
+      self.__publisher.join()
+
   def loop(self):
     """
     No-impl for now, may be used in future
@@ -0,0 +1,70 @@
+import contextlib
+import logging
+import sunspec2.modbus.modbus as mb
+import threading
+import time
+
+
+class AdaptiveLimiter():
+  """
+  Caps the number of requests in flight and tunes the cap AIMD style from what the server can sustain: each request
+  that completes within target_latency while the cap is in use raises the cap by 1/cap (about +1 per cap's worth of
+  requests), an error or a slower request halves it. Decreases are applied at most once per backoff_interval so a
+  burst of failures from one overload only counts once. Modbus exception responses are answers, not errors.
+  """
+
+  def __init__(self, initial_limit: float = 4, min_limit: float = 1, max_limit: float = 16,
+               target_latency: float = 0.5, backoff_interval: float = 1):
+    self.__limit = float(min(initial_limit, max_limit))
+    self.__min_limit = min_limit
+    self.__max_limit = max_limit
+    self.__target_latency = target_latency
+    self.__backoff_interval = backoff_interval
+    self.__last_backoff = 0
+    self.__in_flight = 0
+    self.__cond = threading.Condition()
+
+  @property
+  def limit(self):
+    return int(self.__limit)
+
+  @property
+  def in_flight(self):
+    return self.__in_flight
+
+  @contextlib.contextmanager
+  def request(self):
+    with self.__cond:
+      self.__cond.wait_for(lambda: self.__in_flight < int(self.__limit))
+      self.__in_flight += 1
+
+    start = time.monotonic()
+    ok = False
+    try:
+      yield
+      ok = True
+    except mb.ModbusClientException:
+      ok = True
+      raise
+    finally:
+      self.__release(time.monotonic() - start, ok)
+
+  def __release(self, latency: float, ok: bool):
+    with self.__cond:
+      # Only grow while every slot is in use, otherwise the cap inflates to max_limit without ever being tested
+      saturated = self.__in_flight >= int(self.__limit)
+      self.__in_flight -= 1
+      old_limit = int(self.__limit)
+      if not ok or latency > self.__target_latency:
+        now = time.monotonic()
+        if now - self.__last_backoff >= self.__backoff_interval:
+          self.__last_backoff = now
+          self.__limit = max(self.__min_limit, self.__limit / 2)
+      elif saturated:
+        self.__limit = min(self.__max_limit, self.__limit + 1 / self.__limit)
+      if int(self.__limit) > old_limit:
+        logging.debug("Request limit raised to %s", int(self.__limit))
+      elif int(self.__limit) < old_limit:
+        logging.info("Request limit lowered to %s after %s in %.0fms", int(self.__limit),
+                     'success' if ok else 'error', latency * 1000)
+      self.__cond.notify_all()
@@ -1,10 +1,15 @@
 from absl import app
 from absl import flags
 import homeassistant
+import limiter
 import logging
 import os
 import paho.mqtt.client as mqtt
+import profiling
 import pwrcell
+import signal
+import snapshot
+import spool
 import sunspec2.modbus.client as ss2_client
 import sys
 import tempfile
@@ -13,6 +18,14 @@ import yaml
 import zipfile
 
 
+# Settings used to build components at startup, changing them requires a restart
+RESTART_REQUIRED = [
+    'testing', 'aggregation_window', 'snapshot', 'spool', 'profiling',
+    'pwrcell.device_ids', 'pwrcell.keepalive_interval', 'pwrcell.max_concurrency', 'pwrcell.target_latency',
+    'pwrcell.proxy', 'mqtt.client_name',
+]
+
+
 def on_connect(client, userdata, flags, rc):
   # The callback for when the client receives a CONNACK response from the server.
   print("Connected with result code "+str(rc))
@@ -27,6 +40,131 @@ def on_message(client, userdata, msg):
   print(msg.topic+" "+str(msg.payload))
 
 
+def load_config():
+  with open(os.path.join(sys.path[0], "config.yaml")) as config_file:
+    return yaml.safe_load(config_file)
+
+
+def apply_log_level(config):
+  log_level = logging.getLevelName(config['log_level']) or logging.INFO
+  logging.info("Setting Log Level to %s", logging.getLevelName(log_level))
+  logging.getLogger().setLevel(log_level)
+
+
+def connect_mqtt(mqtt_client: mqtt.Client, mqtt_config):
+  mqtt_client.username_pw_set(mqtt_config['username'], mqtt_config['password'])
+  mqtt_client.connect_async(mqtt_config['host'], mqtt_config['port'], 60)
+
+
+def adaptive_polling(config):
+  adaptive_config = config.get('adaptive_polling')
+  if adaptive_config is None:
+    return None
+  return pwrcell.AdaptivePolling(**adaptive_config)
+
+
+def check_number(value, name: str, minimum: float = 0):
+  if isinstance(value, bool) or not isinstance(value, (int, float)) or value < minimum:
+    raise ValueError("{} must be a number of at least {}, not {!r}".format(name, minimum, value))
+
+
+def validate_config(config):
+  """
+  Raise if any setting main() needs is missing or invalid
+  """
+  if not isinstance(config, dict):
+    raise ValueError("config.yaml must be a mapping, not {}".format(type(config).__name__))
+  for key in ('log_level', 'poll_rate', 'pwrcell', 'mqtt'):
+    if key not in config:
+      raise ValueError("config.yaml is missing {}".format(key))
+  for key in ('host', 'port', 'device_ids'):
+    if key not in config['pwrcell']:
+      raise ValueError("config.yaml is missing pwrcell.{}".format(key))
+  for key in ('host', 'port', 'username', 'password', 'client_name'):
+    if key not in config['mqtt']:
+      raise ValueError("config.yaml is missing mqtt.{}".format(key))
+
+  if not isinstance(logging.getLevelName(config['log_level']), int):
+    raise ValueError("log_level must be a logging level name, not {!r}".format(config['log_level']))
+  check_number(config['poll_rate'], 'poll_rate', minimum=1)
+  for section in ('pwrcell', 'mqtt'):
+    if not isinstance(config[section]['port'], int):
+      raise ValueError("{}.port must be an integer, not {!r}".format(section, config[section]['port']))
+
+  polling = adaptive_polling(config)
+  if polling is not None:
+    for name in ('min_poll_rate', 'max_poll_rate', 'sleep_poll_rate'):
+      check_number(getattr(polling, name), 'adaptive_polling.' + name, minimum=1)
+    for name in ('change_threshold', 'change_deadband'):
+      check_number(getattr(polling, name), 'adaptive_polling.' + name)
+    if polling.min_poll_rate > polling.max_poll_rate:
+      raise ValueError("adaptive_polling.min_poll_rate must not be more than max_poll_rate")
+
+
+def reload_config(config, mqtt_client: mqtt.Client, gpc: pwrcell.GeneracPwrCell):
+  """
+  Re-read config.yaml and apply any changes to the running components without rescanning devices. Returns the
+  config that is now in effect, the old config is kept if the new one cannot be loaded or is invalid.
+  """
+  try:
+    new_config = load_config()
+    validate_config(new_config)
+    return apply_config(config, new_config, mqtt_client, gpc)
+  except Exception:
+    logging.exception("Failed to reload config, keeping running config")
+    return config
+
+
+def apply_config(config, new_config, mqtt_client: mqtt.Client, gpc: pwrcell.GeneracPwrCell):
+  # Work out every change before applying any of them so a failure can't leave the config half applied
+  restart_required = []
+  for key in RESTART_REQUIRED:
+    *sections, name = key.split('.')
+    old_section, new_section = config, new_config
+    for section in sections:
+      old_section, new_section = old_section[section], new_section[section]
+    if new_section.get(name) != old_section.get(name):
+      restart_required.append(key)
+      # Keep the running values of settings that require a restart
+      if name in old_section:
+        new_section[name] = old_section[name]
+      else:
+        del new_section[name]
+
+  old_pwrcell, new_pwrcell = config['pwrcell'], new_config['pwrcell']
+  old_mqtt, new_mqtt = config['mqtt'], new_config['mqtt']
+  log_level_changed = new_config['log_level'] != config['log_level']
+  polling_changed = new_config.get('adaptive_polling') != config.get('adaptive_polling')
+  new_polling = adaptive_polling(new_config)
+  address_changed = (new_pwrcell['host'], new_pwrcell['port']) != (old_pwrcell['host'], old_pwrcell['port'])
+  mqtt_changed = new_mqtt != old_mqtt
+
+  if log_level_changed:
+    apply_log_level(new_config)
+
+  if new_config['poll_rate'] != config['poll_rate']:
+    logging.info("Changing poll rate from %ss to %ss", config['poll_rate'], new_config['poll_rate'])
+
+  if polling_changed:
+    gpc.set_adaptive_polling(new_polling)
+
+  if address_changed:
+    gpc.set_address(new_pwrcell['host'], new_pwrcell['port'])
+
+  if mqtt_changed:
+    logging.info("MQTT settings changed, reconnecting to %s:%s", new_mqtt['host'], new_mqtt['port'])
+    mqtt_client.loop_stop()
+    mqtt_client.disconnect()
+    connect_mqtt(mqtt_client, new_mqtt)
+    mqtt_client.loop_start()
+
+  if restart_required:
+    logging.warning("Changes to %s require a restart, ignoring", ", ".join(restart_required))
+
+  logging.info("Reloaded config")
+  return new_config
+
+
 def on_read(point: ss2_client.SunSpecModbusClientPoint):
   logging.debug("Callback: %s.%s.%s to %s",
                 point.model.device.name, point.model.gname, point.pdef['name'], point.value)
@@ -38,23 +176,35 @@ def main(argv):
   FORMAT = '%(asctime)s [%(levelname)s] [%(threadName)s] %(message)s'
   logging.basicConfig(format=FORMAT, level=logging.INFO)
 
-  config = {}
-  with open(os.path.join(sys.path[0], "config.yaml")) as config_file:
-    config = yaml.safe_load(config_file)
+  config = load_config()
+  validate_config(config)
+  apply_log_level(config)
 
-  log_level = logging.getLevelName(config['log_level']) or logging.INFO
-  logging.info("Setting Log Level to %s", logging.getLevelName(log_level))
-  logging.basicConfig(format=FORMAT, level=log_level)
+  # SIGHUP triggers a reload of config.yaml at the start of the next poll cycle
+  reload_requested = False
+
+  def on_sighup(signum, frame):
+    nonlocal reload_requested
+    reload_requested = True
+  signal.signal(signal.SIGHUP, on_sighup)
+
+  # SIGUSR1 or an ON/OFF message on the profiling command topic toggles profiling of the poll/publish cycle
+  profiling_config = config.get('profiling', {})
+  profiler = profiling.Profiler(
+      output_dir=profiling_config.get('output_dir', os.path.join(sys.path[0], 'profiles')),
+      sample_every=profiling_config.get('sample_every', 10))
+  signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggle())
 
   mqtt_client = mqtt.Client(
       client_id=config['mqtt']['client_name'] + ('_test' if config.get('testing', False) else ''))
   mqtt_client.enable_logger()
   mqtt_client.on_connect = on_connect
   mqtt_client.on_message = on_message
+  connect_mqtt(mqtt_client, config['mqtt'])
 
-  mqtt_client.username_pw_set(
-      config['mqtt']['username'], config['mqtt']['password'])
-  mqtt_client.connect_async(config['mqtt']['host'], config['mqtt']['port'], 60)
+  profiling_topic = "{}/profiling/command".format(config['mqtt']['client_name'])
+  mqtt_client.message_callback_add(
+      profiling_topic, lambda client, userdata, msg: profiler.request(msg.payload.decode('utf-8').upper() == 'ON'))
 
   with tempfile.TemporaryDirectory() as tempdir:
     logging.debug("Extracting sunspec models to %s", tempdir)
@@ -70,27 +220,89 @@ def main(argv):
 
     gpc = pwrcell.GeneracPwrCell(
         device_config, ipaddr=config['pwrcell']['host'], ipport=config['pwrcell']['port'], timeout=60,
-        extra_model_defs=[os.path.join(tempdir, "sunspec-models")])
+        extra_model_defs=[os.path.join(tempdir, "sunspec-models")], profiler=profiler,
+        keepalive_interval=config['pwrcell'].get('keepalive_interval', 30),
+        # Requests to each device are serialized, so more slots than devices are never used
+        request_limiter=limiter.AdaptiveLimiter(
+            max_limit=min(config['pwrcell'].get('max_concurrency', 16),
+                          2 + len(device_config.pv_links) + (1 if device_config.battery > 0 else 0)),
+            target_latency=config['pwrcell'].get('target_latency', 0.5)))
+    initial_polling = adaptive_polling(config)
+    gpc.set_adaptive_polling(initial_polling)
+
+    # States published while the broker is unreachable are buffered on disk
+    state_spool = None
+    spool_config = config.get('spool')
+    if spool_config is not None:
+      state_spool = spool.Spool(
+          spool_config.get('path', os.path.join(sys.path[0], 'spool.sqlite')),
+          max_history=spool_config.get('max_history', 100000),
+          keep_history=spool_config.get('energy_history', True))
+
+    pwrcell_ha = homeassistant.PwrCellHA(
+        gpc, mqtt_client, testing=config.get('testing', False), profiler=profiler, state_spool=state_spool,
+        drain_rate=(spool_config or {}).get('drain_rate', 20), aggregation_window=config.get('aggregation_window', 0),
+        # Reads further apart than a few poll intervals (e.g. while a device is offline) are not averaged across
+        aggregation_max_gap=3 * (initial_polling.max_poll_rate if initial_polling is not None else config['poll_rate']))
+
+    # Last known state from the previous run is published as soon as MQTT connects, before devices are scanned
+    snapshot_config = config.get('snapshot', {})
+    snapshot_path = snapshot_config.get('path', os.path.join(sys.path[0], 'snapshot.json'))
+    snapshot_interval = snapshot_config.get('save_interval', 60)
+    last_snapshot = snapshot.load(snapshot_path)
+    if last_snapshot is not None:
+      pwrcell_ha.restore(last_snapshot, max_age=snapshot_config.get('max_age', homeassistant.EXPIRES_AFTER))
+
+    # Command subscriptions are lost when the broker connection drops or is changed by a reload
+    def on_ha_connect(client, userdata, flags, rc):
+      on_connect(client, userdata, flags, rc)
+      pwrcell_ha.publish_snapshot()
+      pwrcell_ha.subscribe()
+      client.subscribe(profiling_topic)
+    mqtt_client.on_connect = on_ha_connect
+
     try:
       mqtt_client.loop_start()
       gpc.init()
-
-      pwrcell_ha = homeassistant.PwrCellHA(
-          gpc, mqtt_client, testing=config.get('testing', False))
+      # Lets write_point.py skip scanning
+      gpc.save_layout(os.path.join(sys.path[0], "layout.json"))
+      proxy_config = config['pwrcell'].get('proxy')
+      if proxy_config is not None:
+        gpc.start_proxy(host=proxy_config.get('host', '127.0.0.1'), port=proxy_config.get('port', 5502),
+                        max_age=proxy_config.get('max_age', 15))
       pwrcell_ha.init()
 
+      last_snapshot_save = time.time()
       while True:
         start = time.time()
-        gpc.read()
-        pwrcell_ha.loop()
-        sleep_time = max(0, config['poll_rate'] - (time.time() - start))
+        if reload_requested:
+          reload_requested = False
+          config = reload_config(config, mqtt_client, gpc)
+        profiler.begin_cycle()
+        with profiler.span('cycle'):
+          gpc.read()
+          pwrcell_ha.loop()
+        profiler.end_cycle()
+        if time.time() - last_snapshot_save >= snapshot_interval:
+          snapshot.save(snapshot_path, pwrcell_ha.snapshot())
+          last_snapshot_save = time.time()
+        next_read_time = gpc.next_read_time()
+        if next_read_time is None:
+          sleep_time = max(0, config['poll_rate'] - (time.time() - start))
+        else:
+          sleep_time = max(0, next_read_time - time.time())
         logging.debug("Sleep for {}s".format(sleep_time))
         time.sleep(sleep_time)
     except KeyboardInterrupt as e:
       logging.info("Closing: %s", e)
     finally:
       gpc.close()
+      pwrcell_ha.close()
+      snapshot.save(snapshot_path, pwrcell_ha.snapshot())
+      if state_spool is not None:
+        state_spool.close()
       mqtt_client.loop_stop()
+      profiler.dump()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,136 @@
+import contextlib
+import cProfile
+import datetime
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+
+_NOT_PROFILING = contextlib.nullcontext()
+
+
+class Profiler():
+  """
+  Records timed spans of the poll/publish pipeline while enabled and writes them out in the Chrome Trace Event
+  format (loadable by chrome://tracing, Perfetto, speedscope, ...). Every sample_every'th cycle one device read is
+  also run under cProfile and the merged stats written next to the trace.
+
+  Enabling/disabling can be requested from any thread (signal handler, MQTT callback) and is applied at the start of
+  the next cycle. While disabled span() returns a shared no-op context manager.
+  """
+
+  def __init__(self, output_dir: str = '.', sample_every: int = 10, max_spans: int = 100000):
+    self.__output_dir = output_dir
+    self.__sample_every = sample_every
+    self.__max_spans = max_spans
+    self.__enabled = False
+    self.__requested = False
+    self.__cycle = 0
+    self.__sampling = False
+    self.__spans = []
+    self.__thread_names = {}
+    self.__profiles = []
+    self.__profile_lock = threading.Lock()
+
+  @property
+  def enabled(self):
+    return self.__enabled
+
+  def request(self, enabled: bool):
+    """
+    Ask for profiling to be turned on or off at the start of the next cycle
+    """
+    self.__requested = enabled
+
+  def toggle(self):
+    self.request(not self.__requested)
+
+  def begin_cycle(self):
+    if self.__requested != self.__enabled:
+      if self.__requested:
+        logging.info("Profiling enabled, writing traces to %s", self.__output_dir)
+        self.__cycle = 0
+      else:
+        self.dump()
+        logging.info("Profiling disabled")
+      self.__enabled = self.__requested
+
+    if self.__enabled:
+      self.__sampling = self.__sample_every > 0 and self.__cycle % self.__sample_every == 0
+      self.__cycle += 1
+
+  def end_cycle(self):
+    self.__sampling = False
+    if self.__enabled and len(self.__spans) >= self.__max_spans:
+      self.dump()
+
+  def span(self, name: str, **args):
+    if not self.__enabled:
+      return _NOT_PROFILING
+    return self.__span(name, args)
+
+  @contextlib.contextmanager
+  def __span(self, name: str, args):
+    start = time.perf_counter_ns()
+    try:
+      yield
+    finally:
+      thread = threading.current_thread()
+      self.__thread_names.setdefault(thread.ident, thread.name)
+      self.__spans.append((name, thread.ident, start, time.perf_counter_ns(), args))
+
+  def profiled(self, fn, *args, **kwargs):
+    """
+    Call fn, under cProfile if the current cycle is being sampled and no other thread is already being profiled.
+    Python 3.12+ only allows one active profiler, concurrent calls run fn unprofiled.
+    """
+    if not self.__sampling or not self.__profile_lock.acquire(blocking=False):
+      return fn(*args, **kwargs)
+    try:
+      profile = cProfile.Profile()
+      try:
+        profile.enable()
+      except ValueError as e:
+        # Another profiling tool is active (e.g. running under python -m cProfile)
+        logging.debug("Not profiling %s: %s", fn.__name__, e)
+        return fn(*args, **kwargs)
+      try:
+        return fn(*args, **kwargs)
+      finally:
+        profile.disable()
+        self.__profiles.append(profile)
+    finally:
+      self.__profile_lock.release()
+
+  def dump(self):
+    """
+    Write out and clear everything recorded so far
+    """
+    spans, self.__spans = self.__spans, []
+    profiles, self.__profiles = self.__profiles, []
+    if not spans and not profiles:
+      return
+
+    os.makedirs(self.__output_dir, exist_ok=True)
+    suffix = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    pid = os.getpid()
+
+    if spans:
+      events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self.__thread_names.items()]
+      events += [{"name": name, "ph": "X", "pid": pid, "tid": tid, "ts": start / 1000,
+                  "dur": (end - start) / 1000, "args": args} for name, tid, start, end, args in spans]
+      trace_file = os.path.join(self.__output_dir, "pwrcell-trace-{}.json".format(suffix))
+      with open(trace_file, 'w') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+      logging.info("Wrote %s spans to %s", len(spans), trace_file)
+
+    if profiles:
+      stats = pstats.Stats(profiles[0])
+      for profile in profiles[1:]:
+        stats.add(profile)
+      profile_file = os.path.join(self.__output_dir, "pwrcell-profile-{}.pstats".format(suffix))
+      stats.dump_stats(profile_file)
+      logging.info("Wrote %s sampled profiles to %s", len(profiles), profile_file)
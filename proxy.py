@@ -0,0 +1,109 @@
+import logging
+import re
+import socketserver
+import struct
+import sunspec2.modbus.modbus as mb
+import threading
+
+MBAP_LEN = 7
+FUNC_WRITE_SINGLE = 6
+
+EXCEPTION_ILLEGAL_FUNCTION = 0x01
+EXCEPTION_ILLEGAL_ADDRESS = 0x02
+EXCEPTION_DEVICE_FAILURE = 0x04
+EXCEPTION_GATEWAY_PATH = 0x0A
+EXCEPTION_GATEWAY_TARGET = 0x0B
+
+
+class ModbusProxy():
+  """
+  Local Modbus TCP server for other clients (scan.py, Home Assistant's Modbus integration, ...). Holding register
+  reads are answered from the devices' register caches when every register was read or written within max_age
+  seconds, anything else is forwarded upstream over the devices' existing connections.
+  """
+
+  def __init__(self, devices: dict, host: str = '127.0.0.1', port: int = 5502, max_age: float = 15):
+    self.devices = devices
+    self.max_age = max_age
+    self.hits = 0
+    self.misses = 0
+    self.__server = ProxyServer((host, port), ProxyHandler)
+    self.__server.proxy = self
+    self.__thread = threading.Thread(target=self.__server.serve_forever, name='ModbusProxy', daemon=True)
+
+  @property
+  def address(self):
+    return self.__server.server_address
+
+  def start(self):
+    logging.info("Serving Modbus TCP proxy on %s:%s for units %s", *self.address,
+                 ", ".join(str(unit) for unit in self.devices))
+    self.__thread.start()
+
+  def stop(self):
+    self.__server.shutdown()
+    self.__server.server_close()
+
+  def handle(self, unit: int, pdu: bytes):
+    """
+    Response PDU for a request PDU
+    """
+    func = pdu[0]
+    device = self.devices.get(unit)
+    if device is None:
+      return exception_pdu(func, EXCEPTION_GATEWAY_PATH)
+
+    try:
+      if func in (mb.FUNC_READ_HOLDING, mb.FUNC_READ_INPUT):
+        addr, count = struct.unpack('>HH', pdu[1:5])
+        data = None
+        if func == mb.FUNC_READ_HOLDING:
+          data = device.cached_read(addr, count, self.max_age)
+        if data is not None:
+          self.hits += 1
+        else:
+          self.misses += 1
+          data = device.read(addr, count, func)
+        return struct.pack('>BB', func, len(data)) + data
+      elif func == FUNC_WRITE_SINGLE:
+        addr = struct.unpack('>H', pdu[1:3])[0]
+        device.write(addr, pdu[3:5])
+        return pdu[:5]
+      elif func == mb.FUNC_WRITE_MULTIPLE:
+        addr, count, byte_count = struct.unpack('>HHB', pdu[1:6])
+        device.write(addr, pdu[6:6 + byte_count])
+        return struct.pack('>BHH', func, addr, count)
+      return exception_pdu(func, EXCEPTION_ILLEGAL_FUNCTION)
+    except mb.ModbusClientException as e:
+      # Relay the upstream exception code
+      match = re.match(r'Modbus exception:? (\d+)', str(e))
+      return exception_pdu(func, int(match.group(1)) if match else EXCEPTION_DEVICE_FAILURE)
+    except struct.error:
+      return exception_pdu(func, EXCEPTION_ILLEGAL_ADDRESS)
+    except Exception as e:
+      logging.warning("Proxy request to unit %s failed: %s", unit, e)
+      return exception_pdu(func, EXCEPTION_GATEWAY_TARGET)
+
+
+def exception_pdu(func: int, code: int):
+  return struct.pack('>BB', func | 0x80, code)
+
+
+class ProxyServer(socketserver.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+
+class ProxyHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    proxy = self.server.proxy
+    while True:
+      header = self.rfile.read(MBAP_LEN)
+      if len(header) < MBAP_LEN:
+        break
+      transaction_id, protocol_id, length, unit = struct.unpack('>HHHB', header)
+      pdu = self.rfile.read(length - 1)
+      if len(pdu) < length - 1 or not pdu:
+        break
+      response = proxy.handle(unit, pdu)
+      self.wfile.write(struct.pack('>HHHB', transaction_id, protocol_id, len(response) + 1, unit) + response)
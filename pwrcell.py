@@ -2,15 +2,24 @@ from collections.abc import Callable
 from email.policy import default
 from typing import overload
 import concurrent.futures
+import contextlib
 import dataclasses
 import datetime
+import functools
+import json
+import limiter
 import logging
+import profiling
+import proxy
 import sunspec2.device as device
+import sunspec2.mb as ss2_mb
 import sunspec2.mdef as mdef
 import sunspec2.modbus.client as ss2_client
 import sunspec2.modbus.modbus as mb
+import threading
 import time
 import traceback
+import types
 
 
 @dataclasses.dataclass
@@ -21,6 +30,32 @@ class Config:
   battery: int = -1
 
 
+@dataclasses.dataclass
+class AdaptivePolling:
+  """
+  Per-device poll intervals (in seconds) that shrink while a device's values are changing and grow while they are
+  stable. PV links reporting one of the sleep_states are polled at sleep_poll_rate.
+  """
+  min_poll_rate: float = 3
+  max_poll_rate: float = 60
+  sleep_poll_rate: float = 300
+  change_threshold: float = 0.05
+  # Absolute change (in the point's units) ignored as noise, e.g. an idle battery reading a few watts either side of 0
+  change_deadband: float = 5
+  sleep_states: list[str] = dataclasses.field(default_factory=lambda: [
+      'STANDBY', 'WAITING', 'WAITING_NO_INPUT', 'LOW_INPUT_VOLTAGE', 'LOW_SUN'])
+
+
+@dataclasses.dataclass(frozen=True)
+class PointValue:
+  """
+  A point's decoded value as of one read
+  """
+  value: object
+  cvalue: object
+  ts: float
+
+
 def point_id(point: ss2_client.SunSpecModbusClientPoint):
   device = point.model.device
   return "{}.{}.{}".format(device.name, point.model.gname, point.pdef[mdef.NAME])
@@ -55,16 +90,320 @@ def is_uint(point: ss2_client.SunSpecModbusClientPoint):
   return p_type in [mdef.TYPE_UINT16, mdef.TYPE_UINT32, mdef.TYPE_UINT64]
 
 
+@functools.lru_cache(maxsize=None)
+def get_model_def(model_id: int):
+  """
+  Model definitions are shared by every model instance with the same id rather than parsed per device
+  """
+  return device.get_model_def(model_id)
+
+
+class ModelLayout():
+  """
+  Location of a model in a device's register map
+  """
+  __slots__ = ('model_id', 'gname', 'model_addr', 'model_len', 'model')
+
+  def __init__(self, model_id: int, gname: str, model_addr: int, model_len: int):
+    self.model_id = model_id
+    self.gname = gname
+    self.model_addr = model_addr
+    self.model_len = model_len
+    self.model = None
+
+
+class PwrCellDeviceTCP(ss2_client.SunSpecModbusClientDeviceTCP):
+  """
+  SunSpec device whose scan_layout() only records where each model lives, the sunspec2 model and point objects are
+  created the first time a model is accessed (e.g. device.inverter[0]) so only watched models are held in memory.
+  """
+
+  def __init__(self, *args, **kwargs):
+    self.layout = []
+    # Serializes use of the single socket between poll threads and the connection manager
+    self.lock = threading.RLock()
+    self.last_activity = 0
+    # Only set once a connection is established, sunspec2's client reports a socket that is still connecting (or
+    # failed to) as connected
+    self.connected = False
+    # Shared by all devices behind the same Modbus server
+    self.limiter = None
+    # Most recently read/written value of each holding register as address -> (timestamp, 2 bytes)
+    self.registers = {}
+    super().__init__(*args, **kwargs)
+
+  def __request(self):
+    return self.limiter.request() if self.limiter is not None else contextlib.nullcontext()
+
+  def connect(self):
+    # Connect a new client without holding the lock so a slow handshake never blocks a poll, then swap it in
+    client = mb.ModbusClientTCP(slave_id=self.slave_id, ipaddr=self.ipaddr, ipport=self.ipport, timeout=self.timeout,
+                                ctx=self.ctx, trace_func=self.trace_func, max_count=self.max_count,
+                                max_write_count=self.max_write_count)
+    try:
+      client.connect()
+    except Exception:
+      client.disconnect()
+      raise
+    with self.lock:
+      self.client.disconnect()
+      self.client = client
+      self.connected = True
+      self.last_activity = time.time()
+
+  def disconnect(self):
+    with self.lock:
+      self.connected = False
+      super().disconnect()
+
+  def is_connected(self):
+    return self.connected
+
+  def read(self, addr, count, op=mb.FUNC_READ_HOLDING):
+    with self.lock, self.__request():
+      data = super().read(addr, count, op)
+      self.last_activity = time.time()
+      if op == mb.FUNC_READ_HOLDING:
+        self.__cache_registers(addr, data)
+      return data
+
+  def write(self, addr, data):
+    with self.lock, self.__request():
+      super().write(addr, data)
+      self.last_activity = time.time()
+      self.__cache_registers(addr, data)
+
+  def __cache_registers(self, addr: int, data: bytes):
+    now = time.time()
+    for offset in range(len(data) // 2):
+      self.registers[addr + offset] = (now, data[offset * 2:offset * 2 + 2])
+
+  def cached_read(self, addr: int, count: int, max_age: float):
+    """
+    Registers from the most recent reads/writes if all of them are at most max_age seconds old, otherwise None
+    """
+    oldest = time.time() - max_age
+    data = bytearray()
+    for reg in range(addr, addr + count):
+      cached = self.registers.get(reg)
+      if cached is None or cached[0] < oldest:
+        return None
+      data += cached[1]
+    return bytes(data)
+
+  def __getattr__(self, attr):
+    # Only called for attributes that are not set, i.e. model groups
+    if attr.startswith('_') or attr in ('layout', 'models'):
+      raise AttributeError(attr)
+    models = self.get_models(attr)
+    if not models:
+      raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, attr))
+    return models
+
+  def scan_layout(self):
+    """
+    Walk the model headers of the device (two registers per model) without creating any model objects
+    """
+    self.base_addr = None
+    self.layout = []
+    self.delete_models()
+
+    data = None
+    for addr in self.base_addr_list:
+      try:
+        data = self.read(addr, 3)
+      except (ss2_client.SunSpecModbusClientError, mb.ModbusClientError):
+        continue
+      if data[:4] == b'SunS':
+        self.base_addr = addr
+        break
+    if self.base_addr is None:
+      raise ss2_client.SunSpecModbusClientError('No SunSpec register map found on {}'.format(self.name))
+
+    model_id = ss2_mb.data_to_u16(data[4:6])
+    addr = self.base_addr + 2
+    while model_id != ss2_mb.SUNS_END_MODEL_ID:
+      # read model and model len separately due to some devices not supplying count for the end model id
+      model_len_data = self.read(addr + 1, 1)
+      if len(model_len_data) != 2:
+        break
+      model_len = ss2_mb.data_to_u16(model_len_data)
+      try:
+        gname = get_model_def(model_id)[mdef.GROUP][mdef.NAME]
+      except Exception as e:
+        logging.debug("No model definition for %s on %s: %s", model_id, self.name, e)
+        gname = None
+      self.layout.append(ModelLayout(model_id, gname, addr, model_len))
+
+      addr += model_len + 2
+      model_id_data = self.read(addr, 1)
+      if len(model_id_data) != 2:
+        break
+      model_id = ss2_mb.data_to_u16(model_id_data)
+
+  def restore_layout(self, base_addr: int, models: list[list]):
+    """
+    Use a layout saved from a previous scan_layout() (see layout_dict()) instead of scanning the device
+    """
+    self.delete_models()
+    self.base_addr = base_addr
+    self.layout = [ModelLayout(*model) for model in models]
+
+  def verify_model(self, model: ss2_client.SunSpecModbusClientModel) -> bool:
+    """
+    Read the model's ID/L header from the device and check it is still the model and length in the layout, e.g.
+    before writing through a layout restored from a cache
+    """
+    layout = next(layout for layout in self.layout if layout.model is model)
+    data = self.read(layout.model_addr, 2)
+    return ss2_mb.data_to_u16(data[:2]) == layout.model_id and ss2_mb.data_to_u16(data[2:4]) == layout.model_len
+
+  def layout_dict(self):
+    return {
+        'slave_id': self.slave_id,
+        'base_addr': self.base_addr,
+        'models': [[layout.model_id, layout.gname, layout.model_addr, layout.model_len] for layout in self.layout],
+    }
+
+  def get_models_with_point(self, point_name: str) -> list[ss2_client.SunSpecModbusClientModel]:
+    """
+    Models that have a top level point named point_name, only the matching models are created
+    """
+    models = []
+    for layout in self.layout:
+      if layout.gname is None:
+        continue
+      points = get_model_def(layout.model_id)[mdef.GROUP].get(mdef.POINTS, [])
+      if any(pdef[mdef.NAME] == point_name for pdef in points):
+        models += self.get_models(layout.model_id)
+    return list(dict.fromkeys(models))
+
+  def get_models(self, key) -> list[ss2_client.SunSpecModbusClientModel]:
+    """
+    Models by id or group name, creating them from the layout if they have not been accessed yet
+    """
+    models = []
+    for layout in self.layout:
+      if layout.model_id == key or layout.gname == key:
+        if layout.model is None:
+          self.__load_model(layout)
+        models.append(layout.model)
+    return models or self.models.get(key, [])
+
+  def load_models(self):
+    """
+    Create every model in the layout, e.g. before calling get_json()
+    """
+    for layout in self.layout:
+      if layout.model is None:
+        self.__load_model(layout)
+    self.model_list.sort(key=lambda model: model.model_addr)
+
+  def __load_model(self, layout: ModelLayout):
+    header = ss2_mb.u16_to_data(layout.model_id) + ss2_mb.u16_to_data(layout.model_len)
+    model_def = get_model_def(layout.model_id) if layout.gname is not None else None
+    layout.model = self.model_class(model_id=layout.model_id, model_addr=layout.model_addr,
+                                    model_len=layout.model_len, model_def=model_def, data=header, mb_device=self)
+    layout.model.mid = '%s_%s' % (self.did, self.layout.index(layout))
+    self.add_model(layout.model)
+    logging.debug("Loaded %s model %s on %s", layout.gname, layout.model_id, self.name)
+
+
+class ConnectionManager():
+  """
+  Keeps device connections ready for the poll cycle from a background thread. Connections idle for longer than
+  keepalive_interval get a two register read of the SunSpec header, and connections that fail a keepalive or are
+  reported by reconnect() are re-established with backoff so the poll cycle never waits on TCP/tunnel setup.
+  """
+
+  def __init__(self, devices: list[PwrCellDeviceTCP], keepalive_interval: float = 30, max_backoff: float = 30,
+               profiler: profiling.Profiler = None):
+    self.__devices = devices
+    self.__keepalive_interval = keepalive_interval
+    self.__max_backoff = max_backoff
+    self.__profiler = profiler or profiling.Profiler()
+    self.__broken = {}
+    self.__wake = threading.Event()
+    self.__stopped = False
+    self.__thread = threading.Thread(target=self.__run, name='ConnectionManager', daemon=True)
+
+  def start(self):
+    # init() may be called again to rescan devices
+    if self.__thread.ident is None:
+      self.__thread.start()
+
+  def stop(self):
+    self.__stopped = True
+    self.__wake.set()
+    if self.__thread.is_alive():
+      self.__thread.join()
+
+  def reconnect(self, device: PwrCellDeviceTCP):
+    """
+    Drop the device's connection and re-establish it in the background
+    """
+    device.disconnect()
+    self.__broken.setdefault(device, (0, 1))
+    self.__wake.set()
+
+  def __run(self):
+    while not self.__stopped:
+      self.__wake.wait(1)
+      self.__wake.clear()
+      now = time.time()
+      for device in self.__devices:
+        if self.__stopped:
+          break
+        if device in self.__broken:
+          self.__try_connect(device, now)
+        elif now - device.last_activity >= self.__keepalive_interval:
+          self.__keepalive(device)
+
+  def __keepalive(self, device: PwrCellDeviceTCP):
+    try:
+      with self.__profiler.span('keepalive', device=device.name):
+        device.read(device.base_addr if device.base_addr is not None else device.base_addr_list[0], 2)
+      logging.debug("Keepalive %s", device.name)
+    except Exception as e:
+      logging.warning("Keepalive failed for %s, reconnecting: %s", device.name, e)
+      self.reconnect(device)
+
+  def __try_connect(self, device: PwrCellDeviceTCP, now: float):
+    next_try, backoff = self.__broken[device]
+    if now < next_try:
+      return
+    try:
+      with self.__profiler.span('connect', device=device.name):
+        device.connect()
+      del self.__broken[device]
+      logging.info("Reconnected %s", device.name)
+    except mb.ModbusClientError as e:
+      logging.warning("Error reconnecting %s, retrying in %ss: %s", device.name, backoff, e)
+      self.__broken[device] = (now + backoff, min(self.__max_backoff, backoff * 2))
+
+
 class GeneracPwrCell():
-  def __init__(self, device_config: Config, ipaddr='127.0.0.1', ipport=502, timeout=None, extra_model_defs: list[str] = []):
+  def __init__(self, device_config: Config, ipaddr='127.0.0.1', ipport=502, timeout=None, extra_model_defs: list[str] = [],
+               profiler: profiling.Profiler = None, keepalive_interval: float = 30,
+               request_limiter: limiter.AdaptiveLimiter = None):
     # Configure additional model def locations
     device.set_model_defs_path(extra_model_defs + device.get_model_defs_path())
 
     self.__watched_points_by_device = {}
     self.__devices = {}
+    self.__profiler = profiler or profiling.Profiler()
+    self.__adaptive_polling = None
+    self.__poll_rates = {}
+    self.__next_reads = {}
+    self.__last_values = {}
+    # Immutable point_id -> PointValue view of the last read, replaced as a whole so readers never need a lock
+    self.__snapshot = types.MappingProxyType({})
+    self.__snapshot_lock = threading.Lock()
     self.__ipaddr = ipaddr
     self.__ipport = ipport
     self.__iptimeout = timeout
+    # All devices are behind the one Beacon, share a single limit on requests in flight to it
+    self.__limiter = request_limiter or limiter.AdaptiveLimiter()
 
     self.rebus_beacon = self.__init_device(
         'rebus_beacon', device_config.rebus_beacon)
@@ -83,6 +422,9 @@ class GeneracPwrCell():
 
     self.__executor = concurrent.futures.ThreadPoolExecutor(
         thread_name_prefix='ModBusPool', max_workers=(len(self.__devices) * 2))
+    self.__connections = ConnectionManager(
+        list(self.__devices.values()), keepalive_interval=keepalive_interval, profiler=self.__profiler)
+    self.__proxy = None
 
   def __init_device(self, name: str, device_id: int):
     if name in self.__devices:
@@ -90,23 +432,62 @@ class GeneracPwrCell():
     if device_id is None or device_id <= 0:
       raise ValueError("{} id must be set to a positive int".format(name))
 
-    device = ss2_client.SunSpecModbusClientDeviceTCP(
+    device = PwrCellDeviceTCP(
         slave_id=device_id, ipaddr=self.__ipaddr, ipport=self.__ipport, timeout=self.__iptimeout)
     device.name = name
+    device.limiter = self.__limiter
     logging.info("Configured %s at %s:%s on id %s", name,
                  self.__ipaddr, self.__ipport, device_id)
     self.__devices[name] = device
     return device
 
+  def get_point(self, name: str) -> ss2_client.SunSpecModbusClientPoint:
+    """
+    Look up a point on a scanned device by "<device>.<model>.<point>" (as in point_id()) or by "<device>.<point>" if
+    the point name is unique across the device's models. Raises ValueError if there is no such point.
+    """
+    parts = name.split('.')
+    if len(parts) not in (2, 3):
+      raise ValueError("Point name {} must be <device>.<point> or <device>.<model>.<point>".format(name))
+    device = self.__devices.get(parts[0])
+    if device is None:
+      raise ValueError("Unknown device {} in {}, must be one of {}".format(
+          parts[0], name, ", ".join(self.__devices)))
+
+    if len(parts) == 3:
+      models = device.get_models(parts[1])
+    else:
+      models = device.get_models_with_point(parts[1])
+    matches = [model.points[parts[-1]] for model in models if parts[-1] in model.points]
+    if len(matches) != 1:
+      message = "{} matches {} points on {}".format(name, len(matches), device.name)
+      if matches:
+        message += ", use one of " + ", ".join(point_id(point) for point in matches)
+      raise ValueError(message)
+    return matches[0]
+
+  def set_address(self, ipaddr: str, ipport: int):
+    """
+    Point all devices at a new Modbus TCP address, existing scans are kept and devices reconnect in the background
+    """
+    logging.info("Moving devices from %s:%s to %s:%s", self.__ipaddr, self.__ipport, ipaddr, ipport)
+    self.__ipaddr = ipaddr
+    self.__ipport = ipport
+    for device in self.__devices.values():
+      device.ipaddr = ipaddr
+      device.ipport = ipport
+      self.__connections.reconnect(device)
+
   def __connect_device(self, device: ss2_client.SunSpecModbusClientDeviceTCP, tries=3, reconnect=False):
     if not reconnect and device.is_connected():
       return
     for t in range(tries):
       try:
-        device.connect()
+        with self.__profiler.span('connect', device=device.name):
+          device.connect()
         logging.info("Connected %s", device.name)
         break
-      except mb.ModbusClientException as e:
+      except mb.ModbusClientError as e:
         logging.warning("Error connecting %s on try %s: %s", device.name, t, e)
 
   def __scan_device(self, device: ss2_client.SunSpecModbusClientDeviceTCP, tries=3):
@@ -114,8 +495,8 @@ class GeneracPwrCell():
     self.__connect_device(device, tries=tries)
     for t in range(tries):
       try:
-        # Don't read all model data (it is slow)
-        device.scan(connect=False, full_model_read=False)
+        # Only map where the models are, model objects are created when first used
+        device.scan_layout()
         device.common[0].read()
         logging.info("Scanned %s as %s %s - %s",
                      device.name,
@@ -128,11 +509,48 @@ class GeneracPwrCell():
         logging.warning("Error scanning %s on try %s: %s", device.name, t, e)
         self.__connect_device(device, tries=tries, reconnect=True)
 
+  def __restore_device(self, device: PwrCellDeviceTCP, layout: dict, tries=3):
+    self.__connect_device(device, tries=tries)
+    device.restore_layout(layout['base_addr'], layout['models'])
+    for t in range(tries):
+      try:
+        device.common[0].read()
+        logging.info("Restored %s layout as %s %s - %s",
+                     device.name,
+                     device.common[0].Mn.get_value(),
+                     device.common[0].Md.get_value(),
+                     device.common[0].SN.get_value())
+        self.__fix_device(device)
+        break
+      except Exception as e:
+        logging.warning("Error reading %s on try %s: %s", device.name, t, e)
+        self.__connect_device(device, tries=tries, reconnect=True)
+
+  def save_layout(self, path: str):
+    """
+    Save the model layout of every scanned device to path for init(layout_file=...), layouts of other devices already
+    in the file are kept
+    """
+    layouts = self.__load_layouts(path)
+    layouts |= {name: device.layout_dict() for name, device in self.__devices.items() if device.layout}
+    with open(path, 'w') as layout_file:
+      json.dump(layouts, layout_file, indent=2)
+
+  def __load_layouts(self, path: str):
+    try:
+      with open(path) as layout_file:
+        return json.load(layout_file)
+    except FileNotFoundError:
+      return {}
+    except Exception as e:
+      logging.warning("Ignoring unreadable layout cache %s: %s", path, e)
+      return {}
+
   def __fix_device(self, device: ss2_client.SunSpecModbusClientDeviceTCP):
     """
     Apply various overrides/fixes to devices after they have been loaded
     """
-    for string_combiner in device.models.get(404, []):
+    for string_combiner in device.get_models(404):
       # DCW has a scale factor point of DCW_SF but that is set to zero in the system. Clear the sf point
       # reference and manually set the sf_value to -1
       if device.common[0].Vr.value == "634_13700":
@@ -143,11 +561,23 @@ class GeneracPwrCell():
         string_combiner.DCW.sf = None
         string_combiner.DCW.sf_value = -1
 
-  def init(self):
+  def init(self, devices: list[str] = None, layout_file: str = None):
+    """
+    Scan the named devices (all by default), devices with a layout for the same id in layout_file (see save_layout())
+    use it instead of being scanned
+    """
+    layouts = self.__load_layouts(layout_file) if layout_file is not None else {}
+
     # Kick off scans of all devices
     futures_to_devices = {}
-    for device in self.__devices.values():
-      scan_future = self.__executor.submit(self.__scan_device, device)
+    for name, device in self.__devices.items():
+      if devices is not None and name not in devices:
+        continue
+      layout = layouts.get(name)
+      if layout is not None and layout['slave_id'] == device.slave_id:
+        scan_future = self.__executor.submit(self.__restore_device, device, layout)
+      else:
+        scan_future = self.__executor.submit(self.__scan_device, device)
       futures_to_devices[scan_future] = device
 
     # Wait for all the scans to complete
@@ -159,6 +589,17 @@ class GeneracPwrCell():
         # TODO fail hard here?
         logging.error("Failed to scan %s: %s", device.name, exc)
 
+    self.__connections.start()
+
+  def start_proxy(self, host: str = '127.0.0.1', port: int = 5502, max_age: float = 15):
+    """
+    Serve a local Modbus TCP proxy for the configured devices, answering reads from the register cache when it is at
+    most max_age seconds old and forwarding everything else over the existing connections
+    """
+    self.__proxy = proxy.ModbusProxy({device.slave_id: device for device in self.__devices.values()},
+                                     host=host, port=port, max_age=max_age)
+    self.__proxy.start()
+
   def watch_point(self, point: ss2_client.SunSpecModbusClientPoint, callback: Callable[[ss2_client.SunSpecModbusClientPoint], None]):
     device = point.model.device
     points = self.__watched_points_by_device.setdefault(device, dict())
@@ -178,24 +619,129 @@ class GeneracPwrCell():
       self.watch_point(point, callback)
 
   def __read_points(self, device: ss2_client.SunSpecModbusClientDeviceTCP, points: dict[ss2_client.SunSpecModbusClientPoint, Callable[[ss2_client.SunSpecModbusClientPoint]]], tries=3):
-    self.__connect_device(device, tries=tries)
-    for point, callback in points.items():
-      for t in range(tries):
-        try:
-          point.read()
-          logging.debug("Read %s", point_id(point))
-          break
-        except Exception as e:
-          logging.warning("Error reading %s on try %s: %s", device.name, t, e)
-          self.__connect_device(device, tries=tries, reconnect=True)
-      # Execute read callback
-      callback(point)
+    """
+    Reads and decodes the points, returns the PointValue of each point that was read
+    """
+    values = {}
+    with self.__profiler.span('read_device', device=device.name):
+      # Connections are (re)established by the connection manager, never wait on one here
+      if not device.is_connected():
+        logging.warning("Skipping read of %s, not connected", device.name)
+        self.__connections.reconnect(device)
+        return values
+      for point in points:
+        point_name = point.pdef[mdef.NAME]
+        for t in range(tries):
+          try:
+            # Equivalent to point.read(), split so the Modbus request and decoding are profiled separately. The device
+            # lock keeps write_point() from changing the point while it is decoded.
+            with device.lock:
+              with self.__profiler.span('read', device=device.name, point=point_name):
+                data = device.read(point.model.model_addr + point.offset, point.len)
+              with self.__profiler.span('decode', device=device.name, point=point_name):
+                point.set_mb(data=data, dirty=False)
+                values[point] = PointValue(point.value, point.cvalue, time.time())
+            logging.debug("Read %s", point_id(point))
+            break
+          except mb.ModbusClientException as e:
+            # The device answered with an exception response, the connection itself is fine
+            logging.warning("Error reading %s on try %s: %s", device.name, t, e)
+          except Exception as e:
+            logging.warning("Error reading %s, reconnecting in background: %s", device.name, e)
+            self.__connections.reconnect(device)
+            return values
+    return values
 
   def __do_read_points(self, device: ss2_client.SunSpecModbusClientDeviceTCP, points: dict[ss2_client.SunSpecModbusClientPoint, Callable[[ss2_client.SunSpecModbusClientPoint]]], tries=3):
-    return self.__executor.submit(self.__read_points, device, points, tries=tries)
+    return self.__executor.submit(self.__profiler.profiled, self.__read_points, device, points, tries=tries)
+
+  def snapshot(self) -> types.MappingProxyType:
+    """
+    Latest value of every watched point as point_id -> PointValue. The mapping is immutable and replaced after each
+    read, keep a reference to it for a consistent view across points.
+    """
+    return self.__snapshot
+
+  def point_value(self, point: ss2_client.SunSpecModbusClientPoint) -> PointValue:
+    """
+    Latest PointValue of a watched point, None if it hasn't been read yet
+    """
+    return self.__snapshot.get(point_id(point))
+
+  def set_adaptive_polling(self, adaptive_polling: AdaptivePolling = None):
+    """
+    Enable (or disable with None) adaptive per-device polling, each device starts at the minimum poll rate
+    """
+    self.__adaptive_polling = adaptive_polling
+    self.__poll_rates = {}
+    self.__next_reads = {}
+    if adaptive_polling is not None:
+      logging.info("Adaptive polling between %ss and %ss, sleeping PV links every %ss", adaptive_polling.min_poll_rate,
+                   adaptive_polling.max_poll_rate, adaptive_polling.sleep_poll_rate)
+
+  def next_read_time(self):
+    """
+    Time at which the next device is due to be read by read(), None if adaptive polling is disabled
+    """
+    if self.__adaptive_polling is None:
+      return None
+    return min((self.__next_reads.get(device, 0) for device in self.__watched_points_by_device), default=time.time())
 
   def read(self):
-    self.__read(self.__watched_points_by_device)
+    if self.__adaptive_polling is None:
+      self.__read(self.__watched_points_by_device)
+      return
+
+    now = time.time()
+    due = {device: points for device, points in self.__watched_points_by_device.items()
+           if self.__next_reads.get(device, 0) <= now}
+    values = self.__read(due)
+    for device, points in due.items():
+      self.__reschedule(device, {point: values[point] for point in points if point in values}, now)
+
+  def __reschedule(self, device: ss2_client.SunSpecModbusClientDeviceTCP, values: dict, now: float):
+    adaptive_polling = self.__adaptive_polling
+    poll_rate = self.__poll_rates.get(device, adaptive_polling.min_poll_rate)
+
+    if not values:
+      # Nothing was read, an unchanged (stale) value must not back the device off. Retry soon.
+      self.__poll_rates[device] = adaptive_polling.min_poll_rate
+      self.__next_reads[device] = now + adaptive_polling.min_poll_rate
+      return
+
+    # Largest relative change of any numeric point since the previous read of this device
+    max_change = 0
+    for point, point_value in values.items():
+      value = point_value.cvalue
+      if is_enum(point) or not isinstance(value, (int, float)):
+        continue
+      last_value = self.__last_values.get(point)
+      self.__last_values[point] = value
+      if last_value is not None and abs(value - last_value) > adaptive_polling.change_deadband:
+        max_change = max(max_change, abs(value - last_value) / max(abs(value), abs(last_value)))
+
+    if max_change > adaptive_polling.change_threshold:
+      poll_rate = max(adaptive_polling.min_poll_rate, poll_rate / 2)
+    else:
+      poll_rate = min(adaptive_polling.max_poll_rate, poll_rate * 1.5)
+
+    if device in self.pv_links.values() and self.__is_sleeping(device):
+      poll_rate = adaptive_polling.sleep_poll_rate
+
+    if poll_rate != self.__poll_rates.get(device):
+      logging.debug("Polling %s every %.1fs (max change %.3f)", device.name, poll_rate, max_change)
+    self.__poll_rates[device] = poll_rate
+    self.__next_reads[device] = now + poll_rate
+
+  def __is_sleeping(self, device: ss2_client.SunSpecModbusClientDeviceTCP):
+    for rebus_status in device.get_models('REbus_status'):
+      state = self.point_value(rebus_status.St)
+      if state is None or state.value is None:
+        continue
+      for symbol in rebus_status.St.pdef.get(mdef.SYMBOLS, []):
+        if symbol[mdef.VALUE] == state.cvalue:
+          return symbol[mdef.NAME] in self.__adaptive_polling.sleep_states
+    return False
 
   def read_point(self, point: ss2_client.SunSpecModbusClientPoint):
     device = point.model.device
@@ -204,26 +750,59 @@ class GeneracPwrCell():
     callback = points[point]
     self.__read({device: {point: callback}})
 
+  def write_point(self, point: ss2_client.SunSpecModbusClientPoint, cvalue):
+    """
+    Write a watched point and read it back, which updates the snapshot and calls the point's callback
+    """
+    device = point.model.device
+    with device.lock:
+      point.cvalue = cvalue
+      point.write()
+    self.read_point(point)
+
   def __read(self, points: dict[ss2_client.SunSpecModbusClientDeviceTCP, dict[ss2_client.SunSpecModbusClientPoint, Callable[[ss2_client.SunSpecModbusClientPoint]]]]):
+    """
+    Read the points, update the snapshot and run the callbacks, returns the PointValue of each point that was read
+    """
     start = time.time()
     logging.debug("POLLING POINTS")
     futures_to_devices = {}
 
-    # Kick off reads for all watched devices/models
-    for device, points in points.items():
-      futures_to_devices[self.__do_read_points(device, points)] = device
+    with self.__profiler.span('poll'):
+      # Kick off reads for all watched devices/models
+      for device, device_points in points.items():
+        futures_to_devices[self.__do_read_points(device, device_points)] = device
 
-    for future in concurrent.futures.as_completed(futures_to_devices):
-      device = futures_to_devices[future]
-      try:
-        future.result()
-      except Exception as exc:
-        logging.error("Failed to read %s: %s", device.name, exc)
+      values = {}
+      for future in concurrent.futures.as_completed(futures_to_devices):
+        device = futures_to_devices[future]
+        try:
+          values |= future.result()
+        except Exception as exc:
+          logging.error("Failed to read %s: %s", device.name, exc)
+
+      # Publish this read's values as a new snapshot before any callback runs so callbacks see them
+      with self.__snapshot_lock:
+        self.__snapshot = types.MappingProxyType(
+            dict(self.__snapshot) | {point_id(point): value for point, value in values.items()})
+
+      for point in values:
+        callback = points[point.model.device][point]
+        try:
+          with self.__profiler.span('callback', device=point.model.device.name, point=point.pdef[mdef.NAME]):
+            callback(point)
+        except Exception:
+          logging.exception("Read callback for %s failed", point_id(point))
 
     logging.debug("POLLED POINTS IN %fms", (time.time() - start) * 1000)
+    return values
 
   def close(self):
     logging.info("Closing all devices")
+    if self.__proxy is not None:
+      self.__proxy.stop()
+    self.__connections.stop()
     for name, device in self.__devices.items():
-      device.close()
+      # close() doesn't disconnect sunspec2 TCP devices
+      device.disconnect()
       logging.debug('Closed %s', name)
@@ -8,9 +8,9 @@ import datetime
 import json
 import logging
 import os
+import pwrcell
 import sunspec2
 import sunspec2.device as device
-import sunspec2.modbus.client as client
 import sys
 import tempfile
 import time
@@ -50,48 +50,57 @@ def main(argv):
 
     # Does a deep scan to find devices
     for slid in range(1, 100):
-      d = client.SunSpecModbusClientDeviceTCP(
+      d = pwrcell.PwrCellDeviceTCP(
           slave_id=slid, ipaddr=config['pwrcell']['host'], ipport=config['pwrcell']['port'], timeout=60)
-      # Try up to 3 rimes
-      for t in range(3):
-        try:
-          d.scan()
-
-          # Track IDs by Serial > Version > Model > Make > ID tree to detect duplicate devices
-          ids = found_devices.setdefault(d.common[0].SN.value,
-            {}).setdefault(d.common[0].Vr.value,
-            {}).setdefault(d.common[0].Md.value,
-            {}).setdefault(d.common[0].Mn.value,
-            [])
-          ids.append(slid)
+      try:
+        # Try up to 3 rimes
+        for t in range(3):
+          try:
+            # Only the common model is needed to identify the device
+            d.connect()
+            d.scan_layout()
+            d.common[0].read()
+
+            # Track IDs by Serial > Version > Model > Make > ID tree to detect duplicate devices
+            ids = found_devices.setdefault(d.common[0].SN.value,
+              {}).setdefault(d.common[0].Vr.value,
+              {}).setdefault(d.common[0].Md.value,
+              {}).setdefault(d.common[0].Mn.value,
+              [])
+            ids.append(slid)
           
-          if len(ids) > 1:
-            logging.info('Duplicate ID %s is %s %s (%s / %s)',
-              ids,
-              d.common[0].Mn.value,
-              d.common[0].Md.value,
-              d.common[0].Vr.value,
-              d.common[0].SN.value
-            )
-          else:
-            logging.info('Found ID %s is %s %s (%s / %s)',
-              slid,
-              d.common[0].Mn.value,
-              d.common[0].Md.value,
-              d.common[0].Vr.value,
-              d.common[0].SN.value
-            )
-
-            if model_dir_path:
-              model_file = model_dir_path / ('%s.json' % slid)
-              with model_file.open('w') as f:
-                f.write(json.dumps(json.loads(d.get_json()), indent=2))
+            if len(ids) > 1:
+              logging.info('Duplicate ID %s is %s %s (%s / %s)',
+                ids,
+                d.common[0].Mn.value,
+                d.common[0].Md.value,
+                d.common[0].Vr.value,
+                d.common[0].SN.value
+              )
+            else:
+              logging.info('Found ID %s is %s %s (%s / %s)',
+                slid,
+                d.common[0].Mn.value,
+                d.common[0].Md.value,
+                d.common[0].Vr.value,
+                d.common[0].SN.value
+              )
+
+              if model_dir_path:
+                d.load_models()
+                for model in d.model_list:
+                  if model.model_def:
+                    model.read()
+                model_file = model_dir_path / ('%s.json' % slid)
+                with model_file.open('w') as f:
+                  f.write(json.dumps(json.loads(d.get_json()), indent=2))
               
-          break
-        except Exception as e:
-          pass
-
-      d.close()
+            break
+          except Exception as e:
+            pass
+      finally:
+        # close() doesn't disconnect sunspec2 TCP devices
+        d.disconnect()
 
       # TODO update config.yaml?
 
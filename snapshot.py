@@ -0,0 +1,27 @@
+import json
+import logging
+import os
+
+
+def load(path: str):
+  """
+  Load a snapshot written by save(), returns None if there is no usable snapshot at path
+  """
+  try:
+    with open(path) as snapshot_file:
+      return json.load(snapshot_file)
+  except FileNotFoundError:
+    logging.info("No snapshot at %s, starting cold", path)
+  except Exception as e:
+    logging.warning("Ignoring unreadable snapshot %s: %s", path, e)
+  return None
+
+
+def save(path: str, snapshot: dict):
+  """
+  Atomically replace the snapshot at path so a crash mid-write never leaves a truncated file behind
+  """
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as snapshot_file:
+    json.dump(snapshot, snapshot_file, separators=(',', ':'))
+  os.replace(tmp_path, path)
@@ -0,0 +1,71 @@
+import logging
+import sqlite3
+import threading
+
+
+class Spool():
+  """
+  Bounded on-disk store for states that could not be published while the MQTT broker is unreachable. Only the latest
+  state per topic is kept, except for topics spooled with history=True (e.g. energy counters) which keep every
+  state up to max_history rows in total, dropping the oldest. With keep_history=False every topic only keeps its
+  latest state. A None state is stored as NULL and replayed as an empty payload.
+  """
+
+  def __init__(self, path: str, max_history: int = 100000, keep_history: bool = True):
+    self.__max_history = max_history
+    self.__keep_history = keep_history
+    self.__lock = threading.Lock()
+    self.__db = sqlite3.connect(path, check_same_thread=False)
+    self.__db.execute("CREATE TABLE IF NOT EXISTS latest (topic TEXT PRIMARY KEY, ts REAL, payload TEXT)")
+    self.__db.execute(
+        "CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT, ts REAL, payload TEXT)")
+    self.__db.commit()
+    # Counted once, then kept as a running count as counting up to max_history rows on every put is too slow
+    self.__pending = self.__count()
+    if self.__pending:
+      logging.info("Spool %s has %s states from a previous run", path, self.__pending)
+
+  def __count(self):
+    return sum(self.__db.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+               for table in ('latest', 'history'))
+
+  def pending(self):
+    return self.__pending
+
+  def put(self, topic: str, payload, ts: float, history: bool = False):
+    with self.__lock:
+      payload = str(payload) if payload is not None else None
+      if history and self.__keep_history:
+        self.__db.execute("INSERT INTO history (topic, ts, payload) VALUES (?, ?, ?)", (topic, ts, payload))
+        trimmed = self.__db.execute("DELETE FROM history WHERE id <= (SELECT MAX(id) FROM history) - ?",
+                                    (self.__max_history,)).rowcount
+        self.__pending += 1 - trimmed
+      else:
+        replaced = self.__db.execute("SELECT 1 FROM latest WHERE topic = ?", (topic,)).fetchone() is not None
+        self.__db.execute("INSERT OR REPLACE INTO latest (topic, ts, payload) VALUES (?, ?, ?)", (topic, ts, payload))
+        self.__pending += 0 if replaced else 1
+      self.__db.commit()
+
+  def peek(self, limit: int):
+    """
+    Up to limit of the oldest spooled states as (key, topic, payload), pass the keys of published states to remove()
+    """
+    with self.__lock:
+      # latest has at most one row per topic, history is read in id order (insertion, i.e. ts order) off its primary
+      # key rather than sorting every row
+      rows = self.__db.execute(
+          "SELECT 'latest', rowid, topic, payload, ts FROM latest ORDER BY ts LIMIT ?", (limit,)).fetchall()
+      rows += self.__db.execute(
+          "SELECT 'history', id, topic, payload, ts FROM history ORDER BY id LIMIT ?", (limit,)).fetchall()
+    rows.sort(key=lambda row: row[4])
+    return [((table, rowid), topic, payload) for table, rowid, topic, payload, ts in rows[:limit]]
+
+  def remove(self, keys: list):
+    with self.__lock:
+      for table, rowid in keys:
+        self.__pending -= self.__db.execute("DELETE FROM {} WHERE rowid = ?".format(table), (rowid,)).rowcount
+      self.__db.commit()
+
+  def close(self):
+    with self.__lock:
+      self.__db.close()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+from absl import app
+from absl import flags
+import csv
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import pwrcell
+import queue
+import sunspec2.modbus.client as ss2_client
+import sys
+import tempfile
+import threading
+import time
+import yaml
+import zipfile
+
+FLAGS = flags.FLAGS
+flags.DEFINE_list("points", None,
+                  "Points to log as <device>.<model>.<point> or <device>.<point>, e.g. inverter.inverter.W,battery.SoC")
+flags.DEFINE_float("rate", 1.0, "Time in seconds between samples, at least 1")
+flags.DEFINE_string("output_dir", "logs", "Directory to write the log files to")
+flags.DEFINE_enum("format", "csv", ["csv", "jsonl"], "Log file format, files are gzip compressed")
+flags.DEFINE_integer("rotate_minutes", 60, "Start a new log file every N minutes")
+flags.DEFINE_integer("max_files", 0, "Delete the oldest log files beyond this many, 0 keeps all of them")
+flags.DEFINE_integer("buffer_size", 600, "Samples held in memory for the writer, the oldest are dropped when full")
+flags.mark_flag_as_required("points")
+
+FLUSH_INTERVAL = 30
+
+
+class RotatingLogWriter():
+  """
+  Writes samples to gzip compressed CSV or line-delimited JSON files, starting a new file every rotate_seconds and
+  keeping at most max_files of them
+  """
+
+  def __init__(self, output_dir: str, file_format: str, columns: list[str], rotate_seconds: int, max_files: int = 0):
+    self.__output_dir = output_dir
+    self.__file_format = file_format
+    self.__columns = columns
+    self.__rotate_seconds = rotate_seconds
+    self.__max_files = max_files
+    self.__file = None
+    self.__csv = None
+    self.__opened = 0
+    self.__flushed = 0
+    os.makedirs(output_dir, exist_ok=True)
+
+  def write(self, ts: float, values: list):
+    if self.__file is None or ts - self.__opened >= self.__rotate_seconds:
+      self.__rotate(ts)
+
+    if self.__csv is not None:
+      self.__csv.writerow([datetime.datetime.fromtimestamp(ts).isoformat()] + values)
+    else:
+      row = {'ts': datetime.datetime.fromtimestamp(ts).isoformat()} | dict(zip(self.__columns, values))
+      self.__file.write(json.dumps(row) + '\n')
+
+    # Flush periodically rather than per sample, gzip compresses poorly with frequent flushes
+    if ts - self.__flushed >= FLUSH_INTERVAL:
+      self.__file.flush()
+      self.__flushed = ts
+
+  def __rotate(self, ts: float):
+    self.close()
+    path = os.path.join(self.__output_dir, "pwrcell-{}.{}.gz".format(
+        datetime.datetime.fromtimestamp(ts).strftime('%Y%m%d-%H%M%S'), self.__file_format))
+    logging.info("Logging to %s", path)
+    self.__file = gzip.open(path, 'at', newline='')
+    self.__opened = self.__flushed = ts
+    if self.__file_format == 'csv':
+      self.__csv = csv.writer(self.__file)
+      self.__csv.writerow(['ts'] + self.__columns)
+
+    if self.__max_files > 0:
+      log_files = sorted(glob.glob(os.path.join(self.__output_dir, "pwrcell-*.gz")))
+      for old_file in log_files[:-self.__max_files]:
+        logging.info("Removing %s", old_file)
+        os.remove(old_file)
+
+  def close(self):
+    if self.__file is not None:
+      self.__file.close()
+    self.__file = None
+    self.__csv = None
+
+
+def write_samples(samples: queue.Queue, writer: RotatingLogWriter):
+  try:
+    while True:
+      sample = samples.get()
+      if sample is None:
+        break
+      writer.write(*sample)
+  finally:
+    writer.close()
+
+
+def main(argv):
+  del argv  # Unused.
+
+  FORMAT = '%(asctime)s [%(levelname)s] [%(threadName)s] %(message)s'
+  logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+  if FLAGS.rate < 1:
+    raise app.UsageError("--rate must be at least 1 second")
+
+  config = {}
+  with open(os.path.join(sys.path[0], "config.yaml")) as config_file:
+    config = yaml.safe_load(config_file)
+
+  with tempfile.TemporaryDirectory() as tempdir:
+    logging.debug("Extracting sunspec models to %s", tempdir)
+    zf = zipfile.ZipFile(os.path.join(sys.path[0], "sunspec-models.zip"))
+    zf.extractall(tempdir)
+
+    device_config = pwrcell.Config(
+        rebus_beacon=config['pwrcell']['device_ids']['rebus_beacon'],
+        inverter=config['pwrcell']['device_ids']['inverter'],
+        battery=config['pwrcell']['device_ids']['battery'],
+        pv_links=config['pwrcell']['device_ids']['pv_links'],
+    )
+
+    gpc = pwrcell.GeneracPwrCell(
+        device_config, ipaddr=config['pwrcell']['host'], ipport=config['pwrcell']['port'], timeout=60,
+        extra_model_defs=[os.path.join(tempdir, "sunspec-models")])
+
+    samples = queue.Queue(maxsize=FLAGS.buffer_size)
+    writer_thread = None
+    try:
+      gpc.init()
+
+      # Each read callback fills in its column of the current sample
+      points = [gpc.get_point(name) for name in FLAGS.points]
+      columns = [pwrcell.point_id(point) for point in points]
+      sample = [None] * len(points)
+
+      def on_read(point: ss2_client.SunSpecModbusClientPoint, column: int):
+        sample[column] = gpc.point_value(point).cvalue
+      for column, point in enumerate(points):
+        gpc.watch_point(point, lambda p, column=column: on_read(p, column))
+
+      writer = RotatingLogWriter(FLAGS.output_dir, FLAGS.format, columns,
+                                 rotate_seconds=FLAGS.rotate_minutes * 60, max_files=FLAGS.max_files)
+      writer_thread = threading.Thread(target=write_samples, args=(samples, writer), name='LogWriter')
+      writer_thread.start()
+
+      dropped = 0
+      while True:
+        start = time.time()
+        # Points that fail to read are logged as empty rather than repeating the previous cycle's value
+        sample[:] = [None] * len(points)
+        gpc.read()
+
+        # Keep memory flat if the writer falls behind by dropping the oldest buffered sample
+        try:
+          samples.put_nowait((start, list(sample)))
+        except queue.Full:
+          try:
+            samples.get_nowait()
+          except queue.Empty:
+            pass
+          samples.put_nowait((start, list(sample)))
+          dropped += 1
+          logging.warning("Writer is behind, dropped %s samples", dropped)
+
+        time.sleep(max(0, FLAGS.rate - (time.time() - start)))
+    except KeyboardInterrupt as e:
+      logging.info("Closing: %s", e)
+    finally:
+      gpc.close()
+      if writer_thread is not None:
+        samples.put(None)
+        writer_thread.join()
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+from absl import app
+from absl import flags
+import logging
+import os
+import pwrcell
+import sunspec2.mdef as mdef
+import sys
+import tempfile
+import time
+import yaml
+import zipfile
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("layout_cache", None, "Model layout cache shared with main.py, defaults to layout.json next to "
+                    "this script. Devices missing from it are scanned and added.")
+flags.DEFINE_bool("rescan", False, "Scan the device even if it is in the layout cache")
+
+
+def parse_value(point, value: str):
+  # Enums are written by symbol name (e.g. FULL_EXPORT) or by value
+  if pwrcell.is_enum(point):
+    for symbol in point.pdef[mdef.SYMBOLS]:
+      if symbol[mdef.NAME] == value or str(symbol[mdef.VALUE]) == value:
+        return symbol[mdef.VALUE]
+    raise app.UsageError("{} must be one of {}".format(
+        pwrcell.point_id(point), ", ".join(symbol[mdef.NAME] for symbol in point.pdef[mdef.SYMBOLS])))
+  scaled = point.sf is not None or point.sf_value is not None
+  try:
+    return float(value) if scaled else int(value)
+  except ValueError:
+    raise app.UsageError("{} must be {}, not {}".format(
+        pwrcell.point_id(point), "a number" if scaled else "an integer", value))
+
+
+def get_point(gpc: pwrcell.GeneracPwrCell, point_name: str):
+  try:
+    return gpc.get_point(point_name)
+  except ValueError as e:
+    raise app.UsageError(str(e))
+
+
+def main(argv):
+  if len(argv) != 3:
+    raise app.UsageError("Usage: write_point.py <device>.<point> <value>, e.g. battery.SoCRsvMin 85")
+  point_name, value = argv[1], argv[2]
+
+  FORMAT = '%(asctime)s [%(levelname)s] [%(threadName)s] %(message)s'
+  logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+  config = {}
+  with open(os.path.join(sys.path[0], "config.yaml")) as config_file:
+    config = yaml.safe_load(config_file)
+  layout_cache = FLAGS.layout_cache or os.path.join(sys.path[0], "layout.json")
+
+  with tempfile.TemporaryDirectory() as tempdir:
+    logging.debug("Extracting sunspec models to %s", tempdir)
+    zf = zipfile.ZipFile(os.path.join(sys.path[0], "sunspec-models.zip"))
+    zf.extractall(tempdir)
+
+    device_config = pwrcell.Config(
+        rebus_beacon=config['pwrcell']['device_ids']['rebus_beacon'],
+        inverter=config['pwrcell']['device_ids']['inverter'],
+        battery=config['pwrcell']['device_ids']['battery'],
+        pv_links=config['pwrcell']['device_ids']['pv_links'],
+    )
+
+    gpc = pwrcell.GeneracPwrCell(
+        device_config, ipaddr=config['pwrcell']['host'], ipport=config['pwrcell']['port'], timeout=60,
+        extra_model_defs=[os.path.join(tempdir, "sunspec-models")])
+    try:
+      start = time.time()
+      # Only the device being written is connected, from its cached layout unless it has never been scanned
+      device_name = point_name.split('.')[0]
+      gpc.init(devices=[device_name], layout_file=None if FLAGS.rescan else layout_cache)
+
+      # A cached layout is only written through if the model is still where it was scanned, otherwise the write
+      # would land in whichever model moved there
+      point = get_point(gpc, point_name)
+      if not point.model.device.verify_model(point.model):
+        logging.warning("Model layout of %s in %s is out of date, rescanning", device_name, layout_cache)
+        gpc.init(devices=[device_name])
+        point = get_point(gpc, point_name)
+        if not point.model.device.verify_model(point.model):
+          logging.error("Model header of %s does not match the scan, not writing", pwrcell.point_id(point))
+          sys.exit(1)
+      gpc.save_layout(layout_cache)
+
+      if point.pdef.get(mdef.ACCESS) != mdef.ACCESS_RW:
+        raise app.UsageError("{} is read only".format(pwrcell.point_id(point)))
+
+      if point.sf is not None:
+        point.model.points[point.sf].read()
+      point.cvalue = parse_value(point, value)
+      expected = point.value
+
+      # Writes only this point's registers, then reads them back
+      point.write()
+      point.read()
+      if point.value != expected:
+        logging.error("Wrote %s to %s but read back %s", expected, pwrcell.point_id(point), point.value)
+        sys.exit(1)
+      logging.info("Set %s to %s in %.0fms", pwrcell.point_id(point), point.cvalue, (time.time() - start) * 1000)
+    finally:
+      gpc.close()
+
+
+if __name__ == '__main__':
+  app.run(main)